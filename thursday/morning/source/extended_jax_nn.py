@@ -43,6 +43,7 @@ import matplotlib.pyplot as plt
 from typing import List, Tuple, NamedTuple
 from functools import partial
 from time import time
+from jax.sharding import Mesh, NamedSharding, PartitionSpec as P
 
 # %% [markdown]
 # Let's check our environment.
@@ -234,11 +235,12 @@ def initialize_network_params(
 # Here's a jitted function that maps inputs to outputs for a given parameterization of the network.
 
 # %%
-@partial(jax.jit, static_argnames=['activation'])
+@partial(jax.jit, static_argnames=['activation', 'compute_dtype'])
 def forward(
         θ: List[LayerParams],
         x: jnp.ndarray,
-        activation: str
+        activation: str,
+        compute_dtype=None
     ) -> jnp.ndarray:
 
     """
@@ -248,6 +250,8 @@ def forward(
         θ: network parameters
         x: input data
         activation: activation function name (static argument)
+        compute_dtype: if not None, the dtype used for matrix products, such
+            as jnp.bfloat16 (static argument)
     """
 
     # Select the activation function based on name
@@ -267,12 +271,20 @@ def forward(
         # Default to selu
         σ = jax.nn.selu
 
+    def dense(x, W, b):
+        if compute_dtype is None:
+            return x @ W + b
+        # Multiply in compute_dtype, accumulate and add the bias in float32
+        xW = jnp.matmul(x.astype(compute_dtype), W.astype(compute_dtype),
+                        preferred_element_type=jnp.float32)
+        return xW + b
+
     # Apply all layers except the last, with activation
     for W, b in θ[:-1]:
-        x = σ(x @ W + b)
+        x = σ(dense(x, W, b))
     # Apply last layer without activation (for regression)
     W, b = θ[-1]
-    output = x @ W + b
+    output = dense(x, W, b)
 
     return output
 
@@ -284,19 +296,21 @@ def forward(
 # The next function calculates loss associated with a given prediction vector in terms of MSE, conditional on the data set.
 
 # %%
-@partial(jax.jit, static_argnames=['activation'])
+@partial(jax.jit, static_argnames=['activation', 'compute_dtype'])
 def mse_loss(
         params: List[LayerParams], 
         x: jnp.ndarray,
         y: jnp.ndarray,
-        activation: str = "relu"
+        activation: str = "relu",
+        compute_dtype=None
     ) -> jnp.ndarray:
 
     """
     Mean squared error loss function.
 
     """
-    y_pred = forward(params, x, activation=activation)
+    y_pred = forward(params, x, activation=activation,
+                     compute_dtype=compute_dtype)
     return jnp.mean((y_pred - y) ** 2)
 
 
@@ -304,19 +318,21 @@ def mse_loss(
 # When we compute loss, we will use a small amount of regularization to help prevent us from overfitting the existing data set.
 
 # %%
-@partial(jax.jit, static_argnames=['activation'])
+@partial(jax.jit, static_argnames=['activation', 'compute_dtype'])
 def regularized_loss(
         params: List[LayerParams],
         x: jnp.ndarray,
         y: jnp.ndarray,
         activation: str,
-        λ: float
+        λ: float,
+        compute_dtype=None
     ) -> jnp.ndarray:
     """
     Loss function with L2 regularization.
 
     """
-    mse = mse_loss(params, x, y, activation=activation)
+    mse = mse_loss(params, x, y, activation=activation,
+                   compute_dtype=compute_dtype)
 
     # L2 regularization
     l2_penalty = 0.0
@@ -336,22 +352,38 @@ def regularized_loss(
 # containing all parameters.
 #
 # The update uses Optax.
+#
+# We use `jax.value_and_grad`, which returns the loss together with the
+# gradient, so that each step needs only one forward and one backward pass.
+#
+# The optional `compute_dtype` argument sets a precision policy: for example,
+# with `jnp.bfloat16` the matrix products run in bfloat16, while the
+# parameters, gradients and optimizer state remain in float32.
 
 # %%
-def training_step_factory(optimizer, activation: str, regularization_term: float):
+def training_step_factory(
+        optimizer,
+        activation: str,
+        regularization_term: float,
+        compute_dtype=None
+    ):
     """
     Create a JIT-compiled training step function.
 
     """
 
-    # Create a specialized loss gradient function for this activation
-    loss_grad = jax.grad(lambda p, x, y: regularized_loss(p, x, y, activation=activation, λ=regularization_term))
+    # Create a specialized loss-and-gradient function for this activation
+    loss_and_grad = jax.value_and_grad(
+        lambda p, x, y: regularized_loss(
+            p, x, y, activation=activation, λ=regularization_term,
+            compute_dtype=compute_dtype
+        )
+    )
 
     @jax.jit
     def train_step(θ, opt_state, x_batch, y_batch):
         """Single training step."""
-        grads = loss_grad(θ, x_batch, y_batch)
-        loss_val = regularized_loss(θ, x_batch, y_batch, activation=activation, λ=regularization_term)
+        loss_val, grads = loss_and_grad(θ, x_batch, y_batch)
 
         updates, new_opt_state = optimizer.update(grads, opt_state, θ)
         θ = optax.apply_updates(θ, updates)
@@ -590,3 +622,2044 @@ ax.set_ylabel('$y$')
 ax.legend()
 
 plt.show()
+
+# %% [markdown]
+# ## Compiling the Training Loop
+#
+# The training loop above is driven from Python.
+#
+# Every epoch builds a list of batches and every batch triggers a separate call
+# to `train_step_fn`.
+#
+# Over 20,000 epochs that's more than half a million dispatches from Python to
+# the device, plus a host-side average of the batch losses at the end of each
+# epoch.
+#
+# We can do much better by moving the whole loop onto the device.
+#
+# The idea is to use `jax.lax.scan` twice:
+#
+# * an inner scan over the batches within an epoch and
+# * an outer scan over a block of epochs.
+#
+# Shuffling and batch gathering happen inside the compiled function, so the only
+# thing that comes back to the host is the vector of average training losses
+# for the block.
+#
+# Since `scan` requires all batches to have the same shape, each epoch uses
+# `num_samples // batch_size` full batches.
+#
+# The few leftover observations differ from epoch to epoch, because the data are
+# reshuffled every time.
+
+# %%
+def epoch_block_factory(train_step, batch_size: int, epochs_per_block: int):
+    """
+    Create a JIT-compiled function that runs `epochs_per_block` epochs of
+    training on the device and returns the average training loss for each
+    epoch in the block.
+
+    """
+
+    def train_epoch(x, y, carry, key):
+        """Shuffle the data and take one training step per batch."""
+        num_samples = x.shape[0]
+        num_batches = num_samples // batch_size
+
+        # Shuffle and split the indices into (num_batches, batch_size)
+        indices = jax.random.permutation(key, num_samples)
+        indices = indices[:num_batches * batch_size]
+        batch_indices = indices.reshape(num_batches, batch_size)
+
+        def update(carry, idx):
+            θ, opt_state = carry
+            θ, opt_state, loss = train_step(θ, opt_state, x[idx], y[idx])
+            return (θ, opt_state), loss
+
+        carry, batch_losses = jax.lax.scan(update, carry, batch_indices)
+        return carry, jnp.mean(batch_losses)
+
+    @jax.jit
+    def train_block(θ, opt_state, x, y, key):
+        """Run a block of epochs, using one PRNG key per epoch."""
+        keys = jax.random.split(key, epochs_per_block)
+        (θ, opt_state), epoch_losses = jax.lax.scan(
+            partial(train_epoch, x, y), (θ, opt_state), keys
+        )
+        return θ, opt_state, epoch_losses
+
+    return train_block
+
+# %% [markdown]
+# ### Validation on the device
+#
+# In the Python loop above, evaluating the validation loss with `float(...)`
+# forces the host to wait until the device has drained all queued work.
+#
+# The bookkeeping for early stopping (best loss, best parameters and the
+# patience counter) is also done in Python.
+#
+# Instead, we can carry all of this as device state, stored in the following
+# `NamedTuple`.
+
+# %%
+class TrainState(NamedTuple):
+    """
+    Stores everything that changes as training progresses.
+
+    """
+    θ: List[LayerParams]            # current parameters
+    opt_state: optax.OptState       # optimizer state
+    best_θ: List[LayerParams]       # parameters with lowest validation loss
+    best_val_loss: jnp.ndarray      # lowest validation loss so far
+    patience_counter: jnp.ndarray   # evaluations since the last improvement
+    stopped: jnp.ndarray            # True once early stopping is triggered
+
+
+def create_train_state(θ, optimizer) -> TrainState:
+    return TrainState(
+        θ=θ,
+        opt_state=optimizer.init(θ),
+        best_θ=θ,
+        best_val_loss=jnp.array(jnp.inf),
+        patience_counter=jnp.array(0),
+        stopped=jnp.array(False)
+    )
+
+
+# %% [markdown]
+# The next function factory builds a compiled function that trains for a
+# chunk of blocks.
+#
+# After each block it evaluates the validation loss, updates the best parameters
+# and the patience counter, and sets the `stopped` flag when patience runs out.
+#
+# Once `stopped` is set, the remaining blocks leave the state unchanged and
+# report `nan` losses.
+
+# %%
+def training_loop_factory(
+        train_block,
+        activation: str,
+        epochs_per_block: int,
+        blocks_per_chunk: int,
+        patience: int
+    ):
+    """
+    Create a JIT-compiled function that runs `blocks_per_chunk` blocks of
+    training, with validation and early stopping handled on the device.
+
+    """
+
+    def run_block(state, x, y, x_val, y_val, key):
+        θ, opt_state, epoch_losses = train_block(
+            state.θ, state.opt_state, x, y, key
+        )
+        val_loss = mse_loss(θ, x_val, y_val, activation)
+
+        # Update the early stopping state
+        improved = val_loss < state.best_val_loss
+        best_θ = jax.tree.map(
+            lambda new, old: jnp.where(improved, new, old), θ, state.best_θ
+        )
+        best_val_loss = jnp.where(improved, val_loss, state.best_val_loss)
+        patience_counter = jnp.where(improved, 0, state.patience_counter + 1)
+        stopped = patience_counter >= patience
+
+        new_state = TrainState(
+            θ, opt_state, best_θ, best_val_loss, patience_counter, stopped
+        )
+        return new_state, (epoch_losses, val_loss)
+
+    def skip_block(state, x, y, x_val, y_val, key):
+        nan_losses = jnp.full(epochs_per_block, jnp.nan)
+        return state, (nan_losses, jnp.array(jnp.nan))
+
+    @jax.jit
+    def train_chunk(state, x, y, x_val, y_val, key, first_block, num_blocks):
+        """
+        Run blocks first_block, ..., first_block + blocks_per_chunk - 1,
+        skipping any with index num_blocks or above.
+
+        """
+
+        def update(state, block):
+            block_key = jax.random.fold_in(key, block)
+            active = jnp.logical_and(~state.stopped, block < num_blocks)
+            return jax.lax.cond(
+                active, run_block, skip_block,
+                state, x, y, x_val, y_val, block_key
+            )
+
+        blocks = first_block + jnp.arange(blocks_per_chunk)
+        return jax.lax.scan(update, state, blocks)
+
+    return train_chunk
+
+
+# %% [markdown]
+# Each chunk is dispatched without waiting for the previous one to finish.
+#
+# We only read back the `stopped` flag and the losses of the *previous* chunk,
+# which has already completed by the time the current chunk is queued, so the
+# device is never left idle while the host checks on progress.
+#
+# The key for each block is obtained by folding the block number into a single
+# training key, so block `n` always sees the same shuffles.
+
+# %%
+blocks_per_chunk = 10
+train_block = epoch_block_factory(
+    train_step_fn, config.batch_size, config.eval_every
+)
+train_chunk = training_loop_factory(
+    train_block, activation, config.eval_every, blocks_per_chunk, patience
+)
+num_blocks = config.epochs // config.eval_every
+num_chunks = -(-num_blocks // blocks_per_chunk)  # Ceiling division
+
+key, init_key, train_key = jax.random.split(key, 3)
+θ = initialize_network_params(init_key, layer_sizes, activation)
+state = create_train_state(θ, optimizer)
+
+# %% [markdown]
+# Here's a small helper that prints the most recent losses from a finished chunk.
+
+# %%
+def report(first_block, chunk_history):
+    """Print the last training and validation losses in a finished chunk."""
+    epoch_losses, val_losses = map(np.asarray, chunk_history)
+    done = ~np.isnan(val_losses)
+    if done.any():
+        epoch = (first_block + done.sum()) * config.eval_every
+        print(f"Epoch {epoch}: Train Loss = {epoch_losses[done][-1, -1]:.6f}, "
+              f"Val Loss = {val_losses[done][-1]:.6f}")
+
+
+# %% [markdown]
+# Now we train again.
+
+# %%
+history = []
+previous = None
+
+print(f"Starting compiled training for {num_blocks} blocks "
+      f"of {config.eval_every} epochs...")
+start = time()
+
+for chunk in range(num_chunks):
+    first_block = chunk * blocks_per_chunk
+    state, chunk_history = train_chunk(
+        state, x_train, y_train, x_val, y_val,
+        train_key, first_block, num_blocks
+    )
+    history.append(chunk_history)
+
+    # Report on the previous chunk, which has finished by now
+    if previous is not None:
+        prev_stopped, prev_history = previous
+        report(first_block - blocks_per_chunk, prev_history)
+        if prev_stopped:
+            break
+    previous = state.stopped, chunk_history
+
+# Bring the full history back to the host in one go
+epoch_losses, val_losses = jax.device_get(
+    jax.tree.map(lambda *h: np.concatenate(h), *history)
+)
+train_losses = epoch_losses[~np.isnan(val_losses)].flatten()
+val_losses = val_losses[~np.isnan(val_losses)]
+best_val_loss = float(state.best_val_loss)
+elapsed = time() - start
+
+report(first_block, history[-1])
+if state.stopped:
+    print(f"Early stopping triggered at epoch {len(train_losses)}")
+print(f"Training completed in {elapsed:.2f} seconds.")
+print(f"Best validation loss: {best_val_loss:.6f}")
+
+# %% [markdown]
+# The learning curves look much the same as before, while the training time is
+# a small fraction of what the Python loop required.
+
+# %%
+fig, ax = plt.subplots()
+ax.plot(train_losses, label='training Loss')
+ax.plot(np.arange(1, len(val_losses) + 1) * config.eval_every,
+        val_losses, label='validation Loss')
+ax.set_xlabel('epoch')
+ax.set_ylabel('MSE Loss')
+ax.set_title('Learning curves with a compiled training loop')
+ax.legend()
+plt.show()
+
+# %% [markdown]
+# ## Training Ensembles
+#
+# In practice we often want to train many variants of the same model, with
+# different seeds, learning rates or amounts of regularization.
+#
+# Running the whole script once per variant repeats the compilation and leaves
+# most of the hardware idle, since each step only works on one small batch.
+#
+# Because all variants with the same architecture and activation have
+# parameters of the same shape, we can stack them along a new leading axis and
+# train them together with `jax.vmap`.
+#
+# To allow the learning rate to vary across ensemble members, we wrap the
+# construction of the optimizer in a function.
+
+# %%
+def create_optimizer(config: Config):
+    """
+    Adam with gradient clipping and the learning rate schedule in config.
+
+    """
+    return optax.chain(
+        optax.clip_by_global_norm(1.0),  # Gradient clipping for stability
+        optax.adam(learning_rate=create_lr_schedule(config))
+    )
+
+
+# %% [markdown]
+# The next function factory vectorizes the chunked training loop from the
+# previous section over ensemble members.
+#
+# Each member has its own training state, initial learning rate,
+# regularization term and PRNG key, while the data are shared.
+#
+# The activation is a static argument of `forward`, so all members of an
+# ensemble share the activation in `config`.
+
+# %%
+def ensemble_chunk_factory(config: Config, blocks_per_chunk: int, patience: int):
+    """
+    Create a JIT-compiled function that runs one chunk of training for every
+    member of an ensemble.
+
+    """
+    activation = config.activation
+
+    def member_chunk(state, init_lr, λ, key,
+                     x, y, x_val, y_val, first_block, num_blocks):
+        optimizer = create_optimizer(config._replace(init_lr=init_lr))
+        train_step = training_step_factory(optimizer, activation, λ)
+        train_block = epoch_block_factory(
+            train_step, config.batch_size, config.eval_every
+        )
+        train_chunk = training_loop_factory(
+            train_block, activation, config.eval_every,
+            blocks_per_chunk, patience
+        )
+        return train_chunk(
+            state, x, y, x_val, y_val, key, first_block, num_blocks
+        )
+
+    # Map over the state, hyperparameters and keys, but not the data
+    in_axes = (0, 0, 0, 0, None, None, None, None, None, None)
+    return jax.jit(jax.vmap(member_chunk, in_axes=in_axes))
+
+
+# %% [markdown]
+# Now we write the ensemble trainer.
+#
+# It follows the same pattern as the single-network loop above, stopping once
+# every member has triggered early stopping.
+#
+# Members that stop early report `nan` losses for the remaining epochs.
+
+# %%
+class EnsembleResult(NamedTuple):
+    """
+    Stores the outcome of training an ensemble.
+
+    """
+    state: TrainState           # stacked training states
+    train_losses: np.ndarray    # shape (num_members, num_epochs)
+    val_losses: np.ndarray      # shape (num_members, num_evaluations)
+
+
+def train_ensemble(
+        config: Config,
+        seeds: List[int],
+        init_lrs: List[float],
+        regularization_terms: List[float],
+        x_train: jnp.ndarray,
+        y_train: jnp.ndarray,
+        x_val: jnp.ndarray,
+        y_val: jnp.ndarray,
+        blocks_per_chunk: int = 10,
+        patience: int = 50
+    ) -> EnsembleResult:
+    """
+    Train one network per element of seeds, init_lrs and regularization_terms
+    (which must have equal length), all at once.
+
+    """
+    layer_sizes = [x_train.shape[1]] + config.hidden_layers + [y_train.shape[1]]
+    init_lrs = jnp.array(init_lrs, dtype=jnp.float32)
+    λs = jnp.array(regularization_terms, dtype=jnp.float32)
+
+    # Initialize each member from its own seed
+    keys = jax.vmap(jax.random.PRNGKey)(jnp.array(seeds))
+    init_keys, train_keys = jnp.swapaxes(jax.vmap(jax.random.split)(keys), 0, 1)
+    θs = jax.vmap(
+        lambda k: initialize_network_params(k, layer_sizes, config.activation)
+    )(init_keys)
+    state = jax.vmap(lambda θ: create_train_state(θ, create_optimizer(config)))(θs)
+
+    ensemble_chunk = ensemble_chunk_factory(config, blocks_per_chunk, patience)
+    num_blocks = config.epochs // config.eval_every
+    num_chunks = -(-num_blocks // blocks_per_chunk)  # Ceiling division
+
+    history = []
+    prev_stopped = None
+    for chunk in range(num_chunks):
+        state, chunk_history = ensemble_chunk(
+            state, init_lrs, λs, train_keys,
+            x_train, y_train, x_val, y_val,
+            chunk * blocks_per_chunk, num_blocks
+        )
+        history.append(chunk_history)
+        # Stop when every member had stopped by the end of the previous chunk
+        if prev_stopped is not None and prev_stopped.all():
+            break
+        prev_stopped = state.stopped
+
+    # Stack the history along the block axis and drop blocks never run
+    epoch_losses, val_losses = jax.device_get(
+        jax.tree.map(lambda *h: np.concatenate(h, axis=1), *history)
+    )
+    ran = ~np.all(np.isnan(val_losses), axis=0)
+    train_losses = epoch_losses[:, ran].reshape(len(seeds), -1)
+    return EnsembleResult(state, train_losses, val_losses[:, ran])
+
+
+# %% [markdown]
+# Let's try it with eight members: two seeds for each of four initial learning
+# rates.
+#
+# To keep the run time short we train for fewer epochs than above.
+
+# %%
+ensemble_config = config._replace(epochs=2_000)
+init_lr_vals = [0.0005, 0.001, 0.002, 0.004]
+seeds = [0, 1] * len(init_lr_vals)
+init_lrs = sorted(init_lr_vals * 2)
+regularization_terms = [config.regularization_term] * len(seeds)
+
+start = time()
+result = train_ensemble(
+    ensemble_config, seeds, init_lrs, regularization_terms,
+    x_train, y_train, x_val, y_val
+)
+elapsed = time() - start
+print(f"Trained {len(seeds)} networks in {elapsed:.2f} seconds.")
+
+# %% [markdown]
+# Here are the validation curves for each member, along with the best
+# validation loss achieved.
+
+# %%
+fig, ax = plt.subplots()
+eval_epochs = np.arange(1, result.val_losses.shape[1] + 1) * config.eval_every
+for seed, init_lr, curve in zip(seeds, init_lrs, result.val_losses):
+    ax.plot(eval_epochs, curve, label=f'seed {seed}, lr {init_lr}')
+ax.set_xlabel('epoch')
+ax.set_ylabel('validation MSE')
+ax.set_title('Ensemble learning curves')
+ax.legend(fontsize=8)
+plt.show()
+
+for seed, init_lr, loss in zip(seeds, init_lrs, result.state.best_val_loss):
+    print(f"seed = {seed}, init_lr = {init_lr}: best val loss = {loss:.6f}")
+
+# %% [markdown]
+# The best parameters of each member are stored in `result.state.best_θ`,
+# stacked along the first axis, so we can extract the best member as follows.
+
+# %%
+best_member = int(jnp.argmin(result.state.best_val_loss))
+best_ensemble_θ = jax.tree.map(lambda p: p[best_member], result.state.best_θ)
+y_pred = forward(best_ensemble_θ, x_grid.reshape(-1, 1), activation=activation)
+
+fig, ax = plt.subplots()
+ax.plot(x_grid, y_pred.flatten(), color='red', linewidth=2, linestyle='--',
+        label='best ensemble member')
+ax.plot(x_grid, f(x_grid), color='black', linewidth=2, label='true function')
+ax.set_xlabel('$x$')
+ax.set_ylabel('$y$')
+ax.legend()
+plt.show()
+
+# %% [markdown]
+# ## Fused Steps and Mixed Precision
+#
+# Our original version of `training_step_factory` computed the gradient with
+# `jax.grad` and then called `regularized_loss` again to get the loss value,
+# evaluating the forward pass twice per step.
+#
+# The current version uses `jax.value_and_grad` instead.
+#
+# Let's check what this buys us, and also test the bfloat16 precision policy.
+#
+# For comparison, here is the original two-pass step.
+
+# %%
+def two_pass_training_step_factory(
+        optimizer,
+        activation: str,
+        regularization_term: float
+    ):
+    """
+    Create the original training step, which evaluates the loss and its
+    gradient separately.
+
+    """
+    loss_fn = lambda p, x, y: regularized_loss(
+        p, x, y, activation=activation, λ=regularization_term
+    )
+    loss_grad = jax.grad(loss_fn)
+
+    @jax.jit
+    def train_step(θ, opt_state, x_batch, y_batch):
+        grads = loss_grad(θ, x_batch, y_batch)
+        loss_val = loss_fn(θ, x_batch, y_batch)
+        updates, new_opt_state = optimizer.update(grads, opt_state, θ)
+        θ = optax.apply_updates(θ, updates)
+        return θ, new_opt_state, loss_val
+
+    return train_step
+
+
+# %% [markdown]
+# The next function times steady-state training with a given step function,
+# excluding compile time, and records the validation loss after a fixed number
+# of epochs.
+
+# %%
+def benchmark_train_step(
+        train_step,
+        θ: List[LayerParams],
+        optimizer,
+        key: jax.Array,
+        num_epochs: int = 1_000,
+        timing_epochs: int = 100
+    ):
+    """
+    Return steps per second and the validation MSE after num_epochs epochs.
+
+    """
+    num_steps = timing_epochs * (x_train.shape[0] // config.batch_size)
+
+    # Compile and run one block to warm up, then time a second block
+    timed_block = epoch_block_factory(train_step, config.batch_size, timing_epochs)
+    opt_state = optimizer.init(θ)
+    jax.block_until_ready(timed_block(θ, opt_state, x_train, y_train, key))
+    start = time()
+    jax.block_until_ready(timed_block(θ, opt_state, x_train, y_train, key))
+    steps_per_sec = num_steps / (time() - start)
+
+    # Train from scratch to measure accuracy
+    train_block = epoch_block_factory(train_step, config.batch_size, num_epochs)
+    θ, _, _ = train_block(θ, optimizer.init(θ), x_train, y_train, key)
+    val_loss = float(mse_loss(θ, x_val, y_val, activation))
+    return steps_per_sec, val_loss
+
+
+# %% [markdown]
+# Now we compare the two-pass step with the fused step in float32 and in
+# bfloat16, starting from the same parameters and using the same shuffles.
+
+# %%
+key, init_key, bench_key = jax.random.split(key, 3)
+θ_bench = initialize_network_params(init_key, layer_sizes, activation)
+λ = config.regularization_term
+
+step_functions = {
+    'two-pass float32': two_pass_training_step_factory(optimizer, activation, λ),
+    'fused float32': training_step_factory(optimizer, activation, λ),
+    'fused bfloat16': training_step_factory(
+        optimizer, activation, λ, compute_dtype=jnp.bfloat16
+    ),
+}
+
+for name, train_step in step_functions.items():
+    steps_per_sec, val_loss = benchmark_train_step(
+        train_step, θ_bench, optimizer, bench_key
+    )
+    print(f"{name:>18}: {steps_per_sec:10.1f} steps/sec, "
+          f"val MSE = {val_loss:.6f}")
+
+# %% [markdown]
+# When XLA can see both loss computations in the same compiled program it
+# can sometimes eliminate the duplicate work itself, so the gain from fusing
+# varies across hardware.
+#
+# Reduced precision pays off mainly on accelerators with native bfloat16
+# matrix units, such as recent GPUs and TPUs.
+#
+# On CPUs it is often slower, since the casts are extra work and there is no
+# faster arithmetic to offset them.
+
+# %% [markdown]
+# ## Streaming Data
+#
+# So far we have generated the whole data set up front with `generate_data`,
+# and then gathered batches from it.
+#
+# This limits the size of the data set to what fits in memory.
+#
+# Since our data are synthetic, we don't need to store them at all.
+#
+# Instead, we can generate each batch on demand, deriving its PRNG key from a
+# data key, the epoch and the batch index with `jax.random.fold_in`.
+#
+# Each batch has the same distribution as a batch drawn from `generate_data`,
+# and the same `(key, epoch, batch_index)` always produces the same batch.
+
+# %%
+def generate_batch(
+        key: jax.Array,
+        epoch: int,
+        batch_index: int,
+        config: Config
+    ) -> Tuple[jnp.ndarray, jnp.ndarray]:
+    """
+    Generate batch number batch_index of epoch epoch, containing
+    config.batch_size observations.
+
+    """
+    batch_key = jax.random.fold_in(jax.random.fold_in(key, epoch), batch_index)
+    return generate_data(batch_key, config._replace(data_size=config.batch_size))
+
+
+# %% [markdown]
+# Here's a streaming version of `epoch_block_factory`.
+#
+# An epoch now consists of `config.data_size // config.batch_size` freshly
+# generated batches.
+#
+# We also accumulate the batch losses in the loop state instead of storing one
+# value per batch, so memory use does not depend on `config.data_size`.
+#
+# To fit in with `training_loop_factory`, the compiled function has the same
+# signature as before, but ignores the `x` and `y` arguments and uses the key
+# it receives for each block as the data key.
+
+# %%
+def streaming_block_factory(train_step, config: Config, epochs_per_block: int):
+    """
+    Create a JIT-compiled function that runs `epochs_per_block` epochs of
+    training on batches generated on the fly.
+
+    """
+    batches_per_epoch = config.data_size // config.batch_size
+
+    def train_epoch(key, carry, epoch):
+        """Take one training step per generated batch."""
+
+        def update(batch_index, loop_state):
+            θ, opt_state, loss_sum = loop_state
+            x_batch, y_batch = generate_batch(key, epoch, batch_index, config)
+            θ, opt_state, loss = train_step(θ, opt_state, x_batch, y_batch)
+            return θ, opt_state, loss_sum + loss
+
+        # Accumulate the loss rather than storing one value per batch
+        θ, opt_state = carry
+        θ, opt_state, loss_sum = jax.lax.fori_loop(
+            0, batches_per_epoch, update, (θ, opt_state, 0.0)
+        )
+        return (θ, opt_state), loss_sum / batches_per_epoch
+
+    @jax.jit
+    def train_block(θ, opt_state, x, y, key):
+        """Run a block of epochs; x and y are ignored."""
+        epochs = jnp.arange(epochs_per_block)
+        (θ, opt_state), epoch_losses = jax.lax.scan(
+            partial(train_epoch, key), (θ, opt_state), epochs
+        )
+        return θ, opt_state, epoch_losses
+
+    return train_block
+
+
+# %% [markdown]
+# To confirm that memory use is independent of the size of the data set, we
+# compile one epoch of streaming training for a data set of size $10^8$ and for
+# one of size $10^4$, and compare the memory that XLA allocates.
+
+# %%
+def compiled_memory(train_block, θ, opt_state, key):
+    """Total bytes XLA allocates for arguments, outputs and temporaries."""
+    compiled = train_block.lower(θ, opt_state, None, None, key).compile()
+    stats = compiled.memory_analysis()
+    return (stats.argument_size_in_bytes + stats.output_size_in_bytes
+            + stats.temp_size_in_bytes)
+
+for data_size in (10**4, 10**8):
+    stream_config = config._replace(data_size=data_size)
+    stream_block = streaming_block_factory(train_step_fn, stream_config, 1)
+    mem = compiled_memory(stream_block, θ, optimizer.init(θ), key)
+    print(f"data_size = {data_size:>11,}: {mem / 1e6:.2f} MB")
+
+# %% [markdown]
+# Now let's train on a data set of one million points.
+#
+# Each block is a single epoch, and the validation set is the one generated
+# above.
+
+# %%
+stream_config = config._replace(data_size=1_000_000, epochs=5, eval_every=1)
+stream_block = streaming_block_factory(train_step_fn, stream_config, 1)
+num_blocks = stream_config.epochs
+train_chunk = training_loop_factory(
+    stream_block, activation, 1, num_blocks, patience
+)
+
+key, init_key, data_key = jax.random.split(key, 3)
+θ = initialize_network_params(init_key, layer_sizes, activation)
+state = create_train_state(θ, optimizer)
+
+start = time()
+state, (epoch_losses, val_losses) = train_chunk(
+    state, None, None, x_val, y_val, data_key, 0, num_blocks
+)
+val_losses = jax.device_get(val_losses)
+elapsed = time() - start
+
+for epoch, val_loss in enumerate(val_losses, start=1):
+    print(f"Epoch {epoch}: Val Loss = {val_loss:.6f}")
+print(f"Training completed in {elapsed:.2f} seconds.")
+
+# %% [markdown]
+# ## Data Parallel Training
+#
+# When several devices are available, we can split each batch across them.
+#
+# Each device computes the loss and gradient on its share of the batch, after
+# which the gradients are averaged across devices (an "all-reduce").
+#
+# Every device then applies the same update to its own copy of the parameters
+# and optimizer state, so these stay replicated.
+#
+# We express this with `jax.shard_map`, which runs a function on each device
+# with its own block of the data, over a `Mesh` of devices with a single
+# `'batch'` axis.
+#
+# On a machine with only CPUs, JAX exposes a single device by default.
+#
+# To split the CPU into several devices, set the environment variable
+#
+# ```
+# XLA_FLAGS=--xla_force_host_platform_device_count=8
+# ```
+#
+# before starting Python or Jupyter.
+#
+# (We don't set this flag by default, since it slows down single device code on
+# CPUs.)
+
+# %%
+print(f"Number of devices: {jax.device_count()}")
+
+
+# %% [markdown]
+# Here's a data parallel version of `training_step_factory`.
+#
+# The step it returns has the same signature as before, so it plugs straight
+# into `epoch_block_factory` and `training_loop_factory`.
+#
+# The batch size must be divisible by the number of devices in the mesh.
+
+# %%
+def data_parallel_training_step_factory(
+        optimizer,
+        activation: str,
+        regularization_term: float,
+        mesh: Mesh,
+        compute_dtype=None
+    ):
+    """
+    Create a JIT-compiled training step that splits each batch across the
+    devices in mesh and averages the gradients.
+
+    """
+    loss_and_grad = jax.value_and_grad(
+        lambda p, x, y: regularized_loss(
+            p, x, y, activation=activation, λ=regularization_term,
+            compute_dtype=compute_dtype
+        )
+    )
+
+    def local_step(θ, opt_state, x_batch, y_batch):
+        """Training step for one device's share of the batch."""
+        loss_val, grads = loss_and_grad(θ, x_batch, y_batch)
+        # All-reduce: average the loss and gradients over devices
+        loss_val, grads = jax.lax.pmean((loss_val, grads), axis_name='batch')
+        updates, new_opt_state = optimizer.update(grads, opt_state, θ)
+        θ = optax.apply_updates(θ, updates)
+        return θ, new_opt_state, loss_val
+
+    # Parameters and optimizer state are replicated, data are split
+    train_step = jax.shard_map(
+        local_step,
+        mesh=mesh,
+        in_specs=(P(), P(), P('batch'), P('batch')),
+        out_specs=P()
+    )
+    return jax.jit(train_step)
+
+
+# %% [markdown]
+# The next function replicates a pytree across all devices in a mesh.
+
+# %%
+def replicate(tree, mesh: Mesh):
+    return jax.device_put(tree, NamedSharding(mesh, P()))
+
+
+# %% [markdown]
+# Let's train with data parallelism on all available devices, using the
+# chunked training loop from above.
+
+# %%
+mesh = Mesh(jax.devices(), axis_names=('batch',))
+dp_step = data_parallel_training_step_factory(
+    optimizer, activation, config.regularization_term, mesh
+)
+dp_block = epoch_block_factory(dp_step, config.batch_size, config.eval_every)
+dp_config = config._replace(epochs=2_000)
+num_blocks = dp_config.epochs // dp_config.eval_every
+train_chunk = training_loop_factory(
+    dp_block, activation, config.eval_every, num_blocks, patience
+)
+
+key, init_key, train_key = jax.random.split(key, 3)
+θ = initialize_network_params(init_key, layer_sizes, activation)
+state = replicate(create_train_state(θ, optimizer), mesh)
+x_train_r, y_train_r, x_val_r, y_val_r = replicate(
+    (x_train, y_train, x_val, y_val), mesh
+)
+
+start = time()
+state, (epoch_losses, val_losses) = train_chunk(
+    state, x_train_r, y_train_r, x_val_r, y_val_r, train_key, 0, num_blocks
+)
+val_losses = jax.device_get(val_losses)
+elapsed = time() - start
+print(f"Training completed in {elapsed:.2f} seconds "
+      f"on {mesh.size} device(s).")
+print(f"Best validation loss: {float(state.best_val_loss):.6f}")
+
+# %% [markdown]
+# ### Scaling
+#
+# Now we measure how throughput scales with the number of devices.
+#
+# For each device count $n$ we build a mesh from the first $n$ devices and time
+# steady-state training.
+#
+# Parallel efficiency is throughput with $n$ devices divided by $n$ times the
+# throughput with one device.
+#
+# We keep the global batch size fixed, so each device processes
+# `batch_size / n` observations per step.
+
+# %%
+def data_parallel_throughput(
+        num_devices: int,
+        batch_size: int,
+        timing_epochs: int = 20
+    ) -> float:
+    """
+    Return training throughput in samples per second using the first
+    num_devices devices.
+
+    """
+    mesh = Mesh(jax.devices()[:num_devices], axis_names=('batch',))
+    step = data_parallel_training_step_factory(
+        optimizer, activation, config.regularization_term, mesh
+    )
+    block = epoch_block_factory(step, batch_size, timing_epochs)
+    θ_r, opt_state_r, x_r, y_r = replicate(
+        (θ, optimizer.init(θ), x_train, y_train), mesh
+    )
+    num_samples = timing_epochs * (x_train.shape[0] // batch_size) * batch_size
+
+    # Warm up (compile), then time one block
+    jax.block_until_ready(block(θ_r, opt_state_r, x_r, y_r, key))
+    start = time()
+    jax.block_until_ready(block(θ_r, opt_state_r, x_r, y_r, key))
+    return num_samples / (time() - start)
+
+
+# %%
+device_counts = [n for n in (1, 2, 4, 8) if n <= jax.device_count()]
+scaling_batch_size = 8 * config.batch_size
+
+throughput = {}
+for n in device_counts:
+    throughput[n] = data_parallel_throughput(n, scaling_batch_size)
+    efficiency = throughput[n] / (n * throughput[1])
+    print(f"{n} device(s): {throughput[n]:12,.0f} samples/sec, "
+          f"parallel efficiency = {efficiency:.2f}")
+
+# %% [markdown]
+# Bear in mind that devices created with
+# `--xla_force_host_platform_device_count` share the same physical cores, so
+# efficiency on a CPU box depends on how many cores are available to each of
+# them.
+
+# %% [markdown]
+# ## Compilation Caching
+#
+# Every new Python process pays the full cost of compiling `forward`,
+# `mse_loss`, `regularized_loss` and the training step before it can take a
+# single step.
+#
+# Since `activation` is a static argument, a sweep over activations pays this
+# cost once per activation, and `training_step_factory` builds a new step
+# function for every run.
+#
+# We can avoid paying again in later sessions by storing compiled code on disk.
+#
+# JAX has a built-in persistent compilation cache, which we can switch on with
+# a few configuration settings.
+#
+# Loading a cached executable can run arbitrary code, so the cache must live in
+# a directory that only we can write to.  We use a per-user cache directory.
+
+# %%
+import hashlib
+import os
+import shutil
+from contextlib import contextmanager
+from pathlib import Path
+import jaxlib
+from jax.experimental.compilation_cache import compilation_cache
+from jax.experimental.serialize_executable import serialize, deserialize_and_load
+
+cache_root = Path(
+    os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")
+) / "extended_jax_nn"
+
+
+# %%
+def enable_compilation_cache(cache_dir: Path):
+    """
+    Store every executable that JAX compiles from now on in cache_dir, and
+    reuse it in later sessions.
+
+    """
+    cache_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+    jax.config.update("jax_compilation_cache_dir", str(cache_dir))
+    jax.config.update("jax_persistent_cache_min_compile_time_secs", 0)
+    jax.config.update("jax_persistent_cache_min_entry_size_bytes", 0)
+
+enable_compilation_cache(cache_root / "xla")
+
+
+# %% [markdown]
+# When we want to measure compile times, the cache gets in the way.
+#
+# Setting `jax_enable_compilation_cache` to `False` is not enough on its own,
+# since JAX decides whether to use the persistent cache only once per process
+# and remembers the answer.  The context manager below also resets that
+# decision on entry and on exit, and clears the executables that are held in
+# memory, so that everything compiled inside the block is compiled from
+# scratch.
+
+# %%
+@contextmanager
+def compilation_cache_disabled():
+    """
+    Compile everything from scratch while the block runs.
+
+    """
+    enabled = jax.config.jax_enable_compilation_cache
+    jax.config.update("jax_enable_compilation_cache", False)
+    compilation_cache.reset_cache()
+    jax.clear_caches()
+    try:
+        yield
+    finally:
+        jax.config.update("jax_enable_compilation_cache", enabled)
+        compilation_cache.reset_cache()
+
+
+# %% [markdown]
+# The built-in cache is keyed on the compiled program, so JAX still has to trace
+# and lower each function before it can look up the executable.
+#
+# For the functions we use most often, we can also compile them ahead of time
+# (AOT) for declared shapes and store the executables ourselves, skipping the
+# compiler's own optimization passes when loading.
+#
+# Each executable is stored under a hash of the lowered program together with
+# the JAX and jaxlib versions and the device, so a change to the code, the
+# configuration or the software gives a new key rather than a stale executable.
+#
+# Before loading a stored executable we check that it belongs to us and that
+# nobody else can write to it.
+
+# %%
+def executable_key(lowered) -> str:
+    """
+    A short hash identifying a lowered program and the software and device
+    that compile it.
+
+    """
+    device = jax.devices()[0]
+    description = "\n".join((
+        lowered.as_text(), jax.__version__, jaxlib.__version__,
+        device.platform, device.device_kind
+    ))
+    return hashlib.sha256(description.encode()).hexdigest()[:16]
+
+
+def is_trusted(path: Path) -> bool:
+    """
+    Whether path and its directory belong to the current user and are not
+    writable by anyone else.
+
+    """
+    for p in (path, path.parent):
+        status = p.stat()
+        if status.st_uid != os.getuid() or status.st_mode & 0o022:
+            return False
+    return True
+
+
+def load_or_compile(name: str, jitted, args, kwargs, cache_dir: Path):
+    """
+    Load the executable for jitted(*args, **kwargs) from cache_dir if it has
+    been stored there, otherwise compile it and store it.
+
+    The elements of args can be jax.ShapeDtypeStruct instances.
+
+    """
+    lowered = jitted.lower(*args, **kwargs)
+    path = cache_dir / f"{name}-{executable_key(lowered)}.bin"
+    if path.exists() and is_trusted(path):
+        return deserialize_and_load(
+            path.read_bytes(), lowered.in_tree, lowered.out_tree
+        )
+    compiled = lowered.compile()
+    payload, _, _ = serialize(compiled)
+    cache_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+    path.write_bytes(payload)
+    return compiled
+
+
+# %% [markdown]
+# The next function compiles (or loads) the forward pass, the MSE loss and the
+# training step for a given configuration.
+#
+# The returned functions only accept inputs of the declared shapes, but they
+# never trigger compilation.
+
+# %%
+class CompiledFunctions(NamedTuple):
+    """
+    Ahead-of-time compiled functions for one configuration.
+
+    """
+    forward: callable       # (θ, x) -> predictions, x.shape = (num_pred, 1)
+    mse_loss: callable      # (θ, x, y) -> MSE, x.shape = (num_val, 1)
+    train_step: callable    # (θ, opt_state, x_batch, y_batch) -> ...
+
+
+def aot_compile(
+        config: Config,
+        num_val: int,
+        num_pred: int,
+        cache_dir: Path
+    ) -> CompiledFunctions:
+    """
+    Compile forward, mse_loss and the training step built from config for
+    the declared shapes, using the executables in cache_dir when available.
+
+    """
+    activation = config.activation
+    layer_sizes = [1] + config.hidden_layers + [1]
+    optimizer = create_optimizer(config)
+    train_step = training_step_factory(
+        optimizer, activation, config.regularization_term
+    )
+
+    # Abstract arguments: shapes and dtypes only, no data
+    θ_spec = jax.eval_shape(
+        lambda k: initialize_network_params(k, layer_sizes, activation),
+        jax.random.PRNGKey(0)
+    )
+    opt_state_spec = jax.eval_shape(optimizer.init, θ_spec)
+    spec = lambda n: jax.ShapeDtypeStruct((n, 1), jnp.float32)
+
+    return CompiledFunctions(
+        forward=load_or_compile(
+            'forward', forward, (θ_spec, spec(num_pred)),
+            {'activation': activation}, cache_dir
+        ),
+        mse_loss=load_or_compile(
+            'mse_loss', mse_loss, (θ_spec, spec(num_val), spec(num_val)),
+            {'activation': activation}, cache_dir
+        ),
+        train_step=load_or_compile(
+            'train_step', train_step,
+            (θ_spec, opt_state_spec,
+             spec(config.batch_size), spec(config.batch_size)),
+            {}, cache_dir
+        )
+    )
+
+
+# %% [markdown]
+# Let's compare cold and warm start times for a sweep over activations.
+#
+# We clear a dedicated directory first and compile inside
+# `compilation_cache_disabled`, so that the first call for each activation
+# really compiles (a cold start).  The second call loads the stored executables
+# (a warm start, which is what every later session gets).
+
+# %%
+aot_cache_dir = cache_root / "aot"
+shutil.rmtree(aot_cache_dir, ignore_errors=True)
+
+num_val, num_pred = x_val.shape[0], x_grid.shape[0]
+for act in ("selu", "tanh", "gelu"):
+    act_config = config._replace(activation=act)
+    with compilation_cache_disabled():
+        start = time()
+        aot_compile(act_config, num_val, num_pred, aot_cache_dir)
+        cold = time() - start
+    start = time()
+    compiled_fns = aot_compile(act_config, num_val, num_pred, aot_cache_dir)
+    warm = time() - start
+    print(f"{act:>5}: cold start = {cold:.3f} s, warm start = {warm:.3f} s")
+
+# %% [markdown]
+# The compiled functions can be used just like the originals, as long as the
+# inputs have the declared shapes.
+
+# %%
+act_config = config._replace(activation="selu")
+compiled_fns = aot_compile(act_config, num_val, num_pred, aot_cache_dir)
+θ_aot = initialize_network_params(
+    jax.random.PRNGKey(SEED), layer_sizes, "selu"
+)
+opt_state_aot = create_optimizer(act_config).init(θ_aot)
+θ_aot, opt_state_aot, loss = compiled_fns.train_step(
+    θ_aot, opt_state_aot, x_train[:config.batch_size], y_train[:config.batch_size]
+)
+print(f"Training loss on first batch: {loss:.6f}")
+print(f"Validation loss: {compiled_fns.mse_loss(θ_aot, x_val, y_val):.6f}")
+y_pred = compiled_fns.forward(θ_aot, x_grid.reshape(-1, 1))
+
+# %% [markdown]
+# ## Benchmarking
+#
+# So far we have timed individual runs by hand.
+#
+# To catch performance regressions in the training path, it helps to have a
+# benchmark harness that sweeps over configurations, records the same
+# measurements each time and compares them against a stored baseline.
+#
+# For each configuration we record
+#
+# * the time needed to compile the chunked training loop,
+# * steady-state training steps per second,
+# * the time (and number of epochs) needed to reach a target validation MSE and
+# * the peak memory needed by the compiled training loop.
+#
+# Memory is taken from XLA's analysis of the compiled program, which is
+# available on every backend and describes that program alone.  (The peak usage
+# reported by the device would not do, since it covers the whole process and
+# never goes down.)
+
+# %%
+import itertools
+import json
+import platform
+
+
+# %%
+def peak_memory(compiled) -> int:
+    """
+    Peak memory needed to run the compiled program, in bytes.
+
+    """
+    stats = compiled.memory_analysis()
+    return (stats.argument_size_in_bytes + stats.output_size_in_bytes
+            + stats.temp_size_in_bytes - stats.alias_size_in_bytes)
+
+
+def benchmark_config(
+        config: Config,
+        target_val_mse: float,
+        max_epochs: int,
+        patience: int = 50,
+        seed: int = 42
+    ) -> dict:
+    """
+    Train a network with the given configuration for up to max_epochs
+    epochs and return a dictionary of performance measurements.
+
+    """
+    num_blocks = max_epochs // config.eval_every
+    if num_blocks == 0:
+        raise ValueError("max_epochs must be at least config.eval_every")
+
+    key = jax.random.PRNGKey(seed)
+    key, train_data_key, val_data_key, init_key, train_key = \
+        jax.random.split(key, 5)
+    x, y = generate_data(train_data_key, config)
+    x_val, y_val = generate_data(
+        val_data_key, config._replace(data_size=config.data_size // 2)
+    )
+    layer_sizes = [1] + config.hidden_layers + [1]
+    θ = initialize_network_params(init_key, layer_sizes, config.activation)
+
+    optimizer = create_optimizer(config)
+    train_step = training_step_factory(
+        optimizer, config.activation, config.regularization_term
+    )
+    train_block = epoch_block_factory(
+        train_step, config.batch_size, config.eval_every
+    )
+    train_chunk = training_loop_factory(
+        train_block, config.activation, config.eval_every, 1, patience
+    )
+    state = create_train_state(θ, optimizer)
+
+    # Compile the training loop for one block per call, bypassing the
+    # compilation caches so that we measure the true compile time
+    with compilation_cache_disabled():
+        start = time()
+        compiled = train_chunk.lower(
+            state, x, y, x_val, y_val, train_key, 0, num_blocks
+        ).compile()
+        compile_time = time() - start
+
+    # Train block by block, timing each one
+    block_times = []
+    epochs_to_target, time_to_target = None, None
+    for block in range(num_blocks):
+        start = time()
+        state, _ = compiled(state, x, y, x_val, y_val, train_key, block, num_blocks)
+        best_val_loss = float(state.best_val_loss)
+        block_times.append(time() - start)
+        if best_val_loss <= target_val_mse:
+            epochs_to_target = (block + 1) * config.eval_every
+            time_to_target = sum(block_times)
+            break
+
+    # Steady state excludes the first block, which includes warm-up costs
+    steps_per_block = config.eval_every * (config.data_size // config.batch_size)
+    steady_times = block_times[1:] or block_times
+    steps_per_sec = steps_per_block / np.median(steady_times)
+
+    return {
+        'hidden_layers': list(config.hidden_layers),
+        'batch_size': config.batch_size,
+        'data_size': config.data_size,
+        'activation': config.activation,
+        'compile_time': compile_time,
+        'steps_per_sec': steps_per_sec,
+        'epochs_to_target': epochs_to_target,
+        'time_to_target': time_to_target,
+        'best_val_mse': best_val_loss,
+        'peak_memory_bytes': peak_memory(compiled),
+    }
+
+
+# %% [markdown]
+# The next function compares a set of results against a baseline and flags
+# any measurement that got worse by more than a relative tolerance.
+#
+# Results are matched on the configuration fields.
+
+# %%
+benchmark_fields = ('hidden_layers', 'batch_size', 'data_size', 'activation')
+
+# Measurements to compare, and whether higher values are better
+benchmark_metrics = {
+    'compile_time': False,
+    'steps_per_sec': True,
+    'time_to_target': False,
+    'peak_memory_bytes': False,
+}
+
+
+def compare_to_baseline(results: list, baseline: list, tolerance: float = 0.2):
+    """
+    Print the ratio of each measurement to its baseline value and return a
+    list of regressions.
+
+    """
+    point_id = lambda r: tuple(str(r[k]) for k in benchmark_fields)
+    baseline_by_id = {point_id(r): r for r in baseline}
+    regressions = []
+    for r in results:
+        b = baseline_by_id.get(point_id(r))
+        if b is None:
+            print(f"{point_id(r)}: no baseline")
+            continue
+        ratios = []
+        for metric, higher_is_better in benchmark_metrics.items():
+            new, old = r[metric], b[metric]
+            if new is None or old is None or old == 0:
+                ratios.append(f"{metric} n/a")
+                continue
+            ratio = new / old
+            worse = ratio < 1 - tolerance if higher_is_better else ratio > 1 + tolerance
+            if worse:
+                regressions.append((point_id(r), metric, old, new))
+            ratios.append(f"{metric} x{ratio:.2f}{' (!)' if worse else ''}")
+        print(f"{point_id(r)}: " + ", ".join(ratios))
+    return regressions
+
+
+# %% [markdown]
+# Finally, here's the harness itself.
+#
+# It writes the results, together with a description of the environment, to a
+# JSON file.
+#
+# If a baseline file exists, the results are compared against it; otherwise the
+# results are stored as the new baseline.
+
+# %%
+def run_benchmark_suite(
+        base_config: Config,
+        grid: dict,
+        target_val_mse: float,
+        max_epochs: int,
+        results_path: Path,
+        baseline_path: Path,
+        tolerance: float = 0.2
+    ) -> list:
+    """
+    Benchmark every combination of the values in grid, which maps Config
+    field names to lists of values.
+
+    Returns the list of regressions relative to the baseline.
+
+    """
+    results = []
+    names = list(grid)
+    for values in itertools.product(*grid.values()):
+        config = base_config._replace(**dict(zip(names, values)))
+        result = benchmark_config(config, target_val_mse, max_epochs)
+        results.append(result)
+        print(", ".join(f"{k} = {result[k]}" for k in benchmark_fields)
+              + f": {result['steps_per_sec']:,.0f} steps/sec")
+
+    output = {
+        'environment': {
+            'jax_version': jax.__version__,
+            'backend': jax.default_backend(),
+            'device': jax.devices()[0].device_kind,
+            'platform': platform.platform(),
+        },
+        'target_val_mse': target_val_mse,
+        'max_epochs': max_epochs,
+        'results': results,
+    }
+    results_path.parent.mkdir(parents=True, exist_ok=True)
+    results_path.write_text(json.dumps(output, indent=2))
+
+    if not baseline_path.exists():
+        print(f"No baseline found, saving results to {baseline_path}")
+        baseline_path.write_text(json.dumps(output, indent=2))
+        return []
+    baseline = json.loads(baseline_path.read_text())['results']
+    return compare_to_baseline(results, baseline, tolerance)
+
+
+# %% [markdown]
+# Here's a small sweep.
+#
+# Timings are only comparable across runs on the same machine, so the
+# results and the baseline are kept in the per-user cache directory, and the
+# baseline should be regenerated (by deleting the file) when the hardware
+# changes.
+
+# %%
+benchmark_dir = cache_root / "benchmarks"
+benchmark_grid = {
+    'hidden_layers': [[32, 32], [128, 128, 32]],
+    'batch_size': [128, 256],
+    'data_size': [4_000],
+    'activation': ["selu", "tanh"],
+}
+regressions = run_benchmark_suite(
+    config,
+    benchmark_grid,
+    target_val_mse=9.0,
+    max_epochs=500,
+    results_path=benchmark_dir / "nn_results.json",
+    baseline_path=benchmark_dir / "nn_baseline.json"
+)
+print(f"Found {len(regressions)} regression(s).")
+for point, metric, old, new in regressions:
+    print(f"  {point}: {metric} went from {old:.4g} to {new:.4g}")
+
+# %% [markdown]
+# ## Serving Predictions
+#
+# After training, we have made predictions with calls such as
+# `forward(θ, x_grid.reshape(-1, 1), activation=activation)`.
+#
+# Since `forward` is compiled for the shape of its input, every new input length
+# triggers a fresh compilation.
+#
+# That's fine for plotting, but not for an application that answers many
+# prediction requests of varying sizes.
+#
+# In this section we build a small prediction service that
+#
+# * loads saved parameters,
+# * pads each input to one of a small set of power-of-two "bucket" sizes, all
+#   compiled ahead of time, and
+# * combines concurrent requests into a single call to `forward`.
+#
+# We start with functions that save and load network parameters.
+
+# %%
+def save_params(path: Path, θ: List[LayerParams], activation: str):
+    """
+    Save network parameters and the activation name to an .npz file.
+
+    """
+    arrays = {}
+    for i, layer in enumerate(θ):
+        arrays[f"W{i}"] = np.asarray(layer.W)
+        arrays[f"b{i}"] = np.asarray(layer.b)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    np.savez(path, activation=np.array(activation), **arrays)
+
+
+def load_params(path: Path) -> Tuple[List[LayerParams], str]:
+    """
+    Load network parameters and the activation name saved by save_params.
+
+    """
+    with np.load(path) as data:
+        num_layers = sum(name.startswith("W") for name in data.files)
+        θ = [LayerParams(W=jnp.array(data[f"W{i}"]), b=jnp.array(data[f"b{i}"]))
+             for i in range(num_layers)]
+        return θ, str(data["activation"])
+
+
+# %% [markdown]
+# Now we write the service.
+#
+# Requests are placed in a queue, which is drained by a worker thread.
+#
+# The worker waits up to `max_wait` seconds for further requests to arrive,
+# stacks them into one batch of at most `max_batch_size` rows, pads the batch
+# to the next bucket size and runs the precompiled forward pass for that
+# bucket.
+#
+# Each caller receives a `Future` that is resolved with its own slice of the
+# output.
+
+# %%
+import queue
+import tempfile
+import threading
+from concurrent.futures import Future
+
+# Put on the request queue to stop the worker thread
+_STOP = object()
+
+
+class PredictionService:
+    """
+    Serves predictions from a trained network, batching concurrent requests
+    into a single forward pass over a padded, precompiled input shape.
+
+    """
+
+    def __init__(
+            self,
+            θ: List[LayerParams],
+            activation: str,
+            max_batch_size: int = 1024,
+            min_bucket_size: int = 8,
+            max_wait: float = 0.002
+        ):
+        self.θ = jax.device_put(θ)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        # Compile the forward pass for every bucket size up front
+        self.buckets = []
+        size = min_bucket_size
+        while size < max_batch_size:
+            self.buckets.append(size)
+            size *= 2
+        self.buckets.append(max_batch_size)
+        self.executables = {
+            n: forward.lower(
+                self.θ, jax.ShapeDtypeStruct((n, 1), jnp.float32),
+                activation=activation
+            ).compile()
+            for n in self.buckets
+        }
+
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self._serve, daemon=True)
+        self.worker.start()
+
+    def submit(self, x) -> Future:
+        """
+        Queue a request with at most max_batch_size rows and return a Future
+        for the predictions.
+
+        """
+        x = np.asarray(x, dtype=np.float32).reshape(-1, 1)
+        if x.shape[0] > self.max_batch_size:
+            raise ValueError(f"request has more than {self.max_batch_size} rows")
+        future = Future()
+        self.requests.put((x, future))
+        return future
+
+    def predict(self, x) -> np.ndarray:
+        """
+        Return predictions at x, splitting large requests into chunks.
+
+        """
+        x = np.asarray(x, dtype=np.float32).reshape(-1, 1)
+        if x.shape[0] == 0:
+            return np.empty((0, 1), dtype=np.float32)
+        chunks = range(0, x.shape[0], self.max_batch_size)
+        futures = [self.submit(x[i:i + self.max_batch_size]) for i in chunks]
+        return np.concatenate([future.result() for future in futures])
+
+    def close(self):
+        """Stop the worker thread once queued requests have been served."""
+        self.requests.put(_STOP)
+        self.worker.join()
+
+    def _serve(self):
+        pending = None
+        while True:
+            request = self.requests.get() if pending is None else pending
+            pending = None
+            if request is _STOP:
+                return
+
+            # Collect further requests until the batch is full or time is up
+            batch, size = [request], request[0].shape[0]
+            deadline = time() + self.max_wait
+            while size < self.max_batch_size:
+                try:
+                    request = self.requests.get(
+                        timeout=max(deadline - time(), 0)
+                    )
+                except queue.Empty:
+                    break
+                if request is _STOP or size + request[0].shape[0] > self.max_batch_size:
+                    pending = request
+                    break
+                batch.append(request)
+                size += request[0].shape[0]
+
+            self._run_batch(batch, size)
+
+    def _run_batch(self, batch, size):
+        try:
+            bucket = next(n for n in self.buckets if n >= size)
+            x = np.zeros((bucket, 1), dtype=np.float32)
+            x[:size] = np.concatenate([x_request for x_request, _ in batch])
+            y = np.asarray(self.executables[bucket](self.θ, x))
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        start = 0
+        for x_request, future in batch:
+            stop = start + x_request.shape[0]
+            future.set_result(y[start:stop])
+            start = stop
+
+
+# %% [markdown]
+# Let's save the best ensemble member from above to a temporary directory, load
+# it back and start a service.
+
+# %%
+model_dir = Path(tempfile.mkdtemp())
+save_params(model_dir / "best_ensemble_member.npz", best_ensemble_θ, activation)
+
+θ_served, served_activation = load_params(model_dir / "best_ensemble_member.npz")
+start = time()
+service = PredictionService(θ_served, served_activation)
+print(f"Compiled {len(service.buckets)} buckets {service.buckets} "
+      f"in {time() - start:.2f} seconds.")
+
+# %% [markdown]
+# The service agrees with a direct call to `forward`.
+
+# %%
+y_service = service.predict(x_grid)
+y_direct = forward(best_ensemble_θ, x_grid.reshape(-1, 1), activation=activation)
+print(f"Max abs difference: {np.max(np.abs(y_service - y_direct)):.2e}")
+
+# %% [markdown]
+# Now we send many requests of random sizes from several client threads at
+# once.
+#
+# None of these input lengths has been seen before, but no compilation takes
+# place, since each batch is padded to a precompiled bucket.
+
+# %%
+from concurrent.futures import ThreadPoolExecutor
+
+def client_request(seed):
+    rng = np.random.default_rng(seed)
+    x = rng.uniform(-10.0, 10.0, size=rng.integers(1, 200))
+    start = time()
+    service.predict(x)
+    return time() - start
+
+num_requests = 2_000
+start = time()
+with ThreadPoolExecutor(max_workers=32) as pool:
+    latencies = np.array(list(pool.map(client_request, range(num_requests))))
+elapsed = time() - start
+print(f"Served {num_requests} requests in {elapsed:.2f} seconds "
+      f"({num_requests / elapsed:,.0f} requests/sec).")
+print(f"Median latency: {1e3 * np.median(latencies):.2f} ms, "
+      f"99th percentile: {1e3 * np.quantile(latencies, 0.99):.2f} ms.")
+
+# %% [markdown]
+# For access from other processes, we can put the service behind an HTTP
+# server from the standard library.
+#
+# Clients POST a JSON body of the form `{"x": [...]}` to `/predict` and
+# receive `{"y": [...]}` in return.
+
+# %%
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def make_http_server(
+        service: PredictionService,
+        host: str = "127.0.0.1",
+        port: int = 8000
+    ) -> ThreadingHTTPServer:
+    """
+    Build an HTTP server that answers POST /predict requests using service.
+
+    """
+
+    class PredictionHandler(BaseHTTPRequestHandler):
+
+        def do_POST(self):
+            if self.path != "/predict":
+                self.send_error(404)
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                x = json.loads(self.rfile.read(length))["x"]
+                y = service.predict(x)
+            except (ValueError, KeyError, TypeError) as e:
+                self.send_error(400, str(e))
+                return
+            body = json.dumps({"y": y.ravel().tolist()}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass    # Keep the notebook output quiet
+
+    return ThreadingHTTPServer((host, port), PredictionHandler)
+
+
+# %% [markdown]
+# Here we start the server in a background thread on a free port and query it.
+
+# %%
+server = make_http_server(service, port=0)
+server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+server_thread.start()
+
+url = f"http://127.0.0.1:{server.server_address[1]}/predict"
+request = urllib.request.Request(
+    url,
+    data=json.dumps({"x": [-5.0, 0.0, 5.0]}).encode(),
+    headers={"Content-Type": "application/json"}
+)
+with urllib.request.urlopen(request) as response:
+    print(json.loads(response.read()))
+
+server.shutdown()
+server.server_close()
+service.close()
+
+
+# %% [markdown]
+# ## Checkpointing
+#
+# A full training run keeps the parameters, the optimizer state and the loss
+# history only in memory, so a crash loses everything.
+#
+# In this section we write periodic checkpoints to disk and add a way to
+# resume a run that reproduces the uninterrupted run exactly.
+#
+# ### A flat file format
+#
+# Each checkpoint is a single file laid out as follows:
+#
+# * 8 bytes of magic identifying the format,
+# * 8 bytes giving the length of a JSON header,
+# * the JSON header, listing the name, dtype, shape and byte offset of every
+#   array along with any metadata, and
+# * the raw array data, with each array aligned to 64 bytes.
+#
+# Because the arrays are stored uncompressed at known offsets, they can be
+# memory-mapped with `np.memmap`, so reading a single array (say, the best
+# parameters for inference) does not require loading the whole file.
+#
+# Array names are the pytree paths of the leaves, which makes the files easy
+# to inspect.
+#
+# Files are first written under a temporary name and then renamed, so a crash
+# during a write never leaves a corrupt checkpoint behind.
+
+# %%
+CHECKPOINT_MAGIC = b"JAXCKPT1"
+CHECKPOINT_ALIGN = 64
+
+
+def write_checkpoint(path: Path, tree, metadata: dict):
+    """
+    Write the leaves of a pytree of arrays, together with JSON metadata, to a
+    single flat binary file.
+
+    """
+    leaves_with_paths, _ = jax.tree_util.tree_flatten_with_path(tree)
+    arrays = [np.asarray(leaf) for _, leaf in leaves_with_paths]
+
+    # Lay out the arrays after the header, each aligned to CHECKPOINT_ALIGN
+    entries, offset = [], 0
+    for (leaf_path, _), a in zip(leaves_with_paths, arrays):
+        entries.append({
+            'name': jax.tree_util.keystr(leaf_path),
+            'dtype': a.dtype.str,
+            'shape': list(a.shape),
+            'offset': offset,
+        })
+        offset += -(-a.nbytes // CHECKPOINT_ALIGN) * CHECKPOINT_ALIGN
+    header = json.dumps({'metadata': metadata, 'arrays': entries}).encode()
+    data_start = -(-(16 + len(header)) // CHECKPOINT_ALIGN) * CHECKPOINT_ALIGN
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(CHECKPOINT_MAGIC)
+        f.write(len(header).to_bytes(8, "little"))
+        f.write(header)
+        for entry, a in zip(entries, arrays):
+            f.seek(data_start + entry['offset'])
+            f.write(a.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_checkpoint(path: Path, like):
+    """
+    Read a checkpoint written by write_checkpoint, returning a pytree with the
+    structure of `like` whose leaves are memory-mapped arrays, along with the
+    metadata.
+
+    """
+    with open(path, "rb") as f:
+        if f.read(8) != CHECKPOINT_MAGIC:
+            raise ValueError(f"{path} is not a checkpoint file")
+        header_size = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_size))
+    data_start = -(-(16 + header_size) // CHECKPOINT_ALIGN) * CHECKPOINT_ALIGN
+
+    leaves_with_paths, treedef = jax.tree_util.tree_flatten_with_path(like)
+    names = [jax.tree_util.keystr(leaf_path) for leaf_path, _ in leaves_with_paths]
+    if names != [entry['name'] for entry in header['arrays']]:
+        raise ValueError(f"{path} does not match the structure of `like`")
+
+    leaves = []
+    for entry in header['arrays']:
+        shape = tuple(entry['shape'])
+        if np.prod(shape) == 0:
+            leaves.append(np.empty(shape, dtype=entry['dtype']))
+        else:
+            leaves.append(np.memmap(path, dtype=entry['dtype'], mode='r',
+                                    offset=data_start + entry['offset'],
+                                    shape=shape))
+    return jax.tree.unflatten(treedef, leaves), header['metadata']
+
+
+# %% [markdown]
+# ### Writing in the background
+#
+# Writing to disk should not hold up training.
+#
+# The `CheckpointWriter` below hands checkpoints to a background thread.
+#
+# When a checkpoint is submitted we start copying its arrays to the host with
+# `copy_to_host_async` and return immediately, so the next chunk of training is
+# dispatched while the copy and the write proceed.
+#
+# At most one checkpoint waits in the queue; if the disk falls behind,
+# `save` blocks instead of piling up copies of the state in memory.
+#
+# JAX arrays are immutable, so the training loop can move on to new arrays
+# without disturbing those being written.
+
+# %%
+class CheckpointWriter:
+    """
+    Writes checkpoints to a single path on a background thread.
+
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.requests = queue.Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def save(self, tree, metadata: dict):
+        """Queue the pytree `tree` for writing and return immediately."""
+        if self.error is not None:
+            raise self.error
+        for leaf in jax.tree.leaves(tree):
+            if isinstance(leaf, jax.Array):
+                leaf.copy_to_host_async()
+        self.requests.put((tree, metadata))
+
+    def close(self):
+        """Wait for queued checkpoints to be written and stop the thread."""
+        self.requests.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _write_loop(self):
+        while (request := self.requests.get()) is not None:
+            tree, metadata = request
+            try:
+                write_checkpoint(self.path, jax.device_get(tree), metadata)
+            except Exception as e:
+                self.error = e
+
+
+# %% [markdown]
+# ### Resuming
+#
+# A checkpoint holds everything needed to continue training: the training
+# state (current and best parameters, optimizer state, early stopping
+# counters), the training key and the loss history.
+#
+# The index of the next block to run is stored in the metadata.
+#
+# Since the key for block `n` is always `fold_in(train_key, n)`, a resumed run
+# sees exactly the same shuffles as an uninterrupted one, and hence produces
+# the same results bit for bit.
+
+# %%
+class Checkpoint(NamedTuple):
+    """
+    Stores everything needed to resume training.
+
+    """
+    state: TrainState
+    key: jnp.ndarray                # training key, folded with block numbers
+    epoch_losses: jnp.ndarray       # training losses, one row per block
+    val_losses: jnp.ndarray         # validation loss after each block
+
+
+def train_with_checkpoints(
+        train_chunk,
+        state: TrainState,
+        x_train, y_train, x_val, y_val,
+        key,
+        num_blocks: int,
+        blocks_per_chunk: int,
+        checkpoint_path: Path,
+        checkpoint_every: int = 10,
+        resume: bool = True
+    ) -> Checkpoint:
+    """
+    Run compiled training chunks, writing a checkpoint every
+    `checkpoint_every` chunks and at the end of training.
+
+    If `resume` is True and a checkpoint exists at `checkpoint_path`, the
+    state, key and loss history are restored from it and training continues
+    from the next block.  If the checkpoint already covers all num_blocks
+    blocks, it is returned without further training.  The returned loss
+    history contains `nan` for blocks skipped after early stopping.
+
+    """
+    history = []
+    first_chunk = 0
+    if resume and checkpoint_path.exists():
+        like = Checkpoint(state, key, jnp.zeros(0), jnp.zeros(0))
+        checkpoint, metadata = read_checkpoint(checkpoint_path, like)
+        if metadata['blocks_per_chunk'] != blocks_per_chunk:
+            raise ValueError("checkpoint was written with a different chunk size")
+        state = jax.tree.map(jnp.asarray, checkpoint.state)
+        key = jnp.asarray(checkpoint.key)
+        history.append((jnp.asarray(checkpoint.epoch_losses),
+                        jnp.asarray(checkpoint.val_losses)))
+        first_chunk = metadata['next_block'] // blocks_per_chunk
+        print(f"Resuming from block {metadata['next_block']}.")
+
+    def make_checkpoint():
+        epoch_losses, val_losses = jax.tree.map(
+            lambda *h: jnp.concatenate(h), *history
+        )
+        return Checkpoint(state, key, epoch_losses, val_losses)
+
+    num_chunks = -(-num_blocks // blocks_per_chunk)
+    if first_chunk >= num_chunks:
+        if not history:
+            raise ValueError("num_blocks must be positive")
+        return make_checkpoint()
+
+    writer = CheckpointWriter(checkpoint_path)
+    previous_stopped = state.stopped if history else None
+    saved_chunk = None
+    try:
+        for chunk in range(first_chunk, num_chunks):
+            state, chunk_history = train_chunk(
+                state, x_train, y_train, x_val, y_val,
+                key, chunk * blocks_per_chunk, num_blocks
+            )
+            history.append(chunk_history)
+            if (chunk + 1) % checkpoint_every == 0:
+                writer.save(make_checkpoint(), {
+                    'next_block': (chunk + 1) * blocks_per_chunk,
+                    'blocks_per_chunk': blocks_per_chunk,
+                })
+                saved_chunk = chunk
+
+            # Stop if the previous chunk, which has finished by now, stopped
+            if previous_stopped is not None and previous_stopped:
+                break
+            previous_stopped = state.stopped
+
+        checkpoint = make_checkpoint()
+        if saved_chunk != chunk:
+            writer.save(checkpoint, {
+                'next_block': (chunk + 1) * blocks_per_chunk,
+                'blocks_per_chunk': blocks_per_chunk,
+            })
+    finally:
+        writer.close()
+    return checkpoint
+
+
+# %% [markdown]
+# Let's check that resuming reproduces an uninterrupted run.
+#
+# We rebuild the single-device training chunk from above, and first train for
+# all blocks in one go.
+#
+# To keep the demonstration quick we train for fewer epochs than above, and
+# write the checkpoints to a temporary directory.
+
+# %%
+train_chunk = training_loop_factory(
+    train_block, activation, config.eval_every, blocks_per_chunk, patience
+)
+checkpoint_epochs = 4_000
+num_blocks = checkpoint_epochs // config.eval_every
+
+checkpoint_dir = Path(tempfile.mkdtemp())
+
+key, init_key, train_key = jax.random.split(key, 3)
+θ = initialize_network_params(init_key, layer_sizes, activation)
+initial_state = create_train_state(θ, optimizer)
+
+uninterrupted = train_with_checkpoints(
+    train_chunk, initial_state, x_train, y_train, x_val, y_val,
+    train_key, num_blocks, blocks_per_chunk,
+    checkpoint_dir / "uninterrupted.ckpt"
+)
+
+# %% [markdown]
+# Next we simulate a crash by stopping a second run halfway, and then resume
+# it from its last checkpoint.
+
+# %%
+half_blocks = max(num_blocks // 2 // blocks_per_chunk, 1) * blocks_per_chunk
+train_with_checkpoints(
+    train_chunk, initial_state, x_train, y_train, x_val, y_val,
+    train_key, half_blocks, blocks_per_chunk,
+    checkpoint_dir / "interrupted.ckpt"
+)
+resumed = train_with_checkpoints(
+    train_chunk, initial_state, x_train, y_train, x_val, y_val,
+    train_key, num_blocks, blocks_per_chunk,
+    checkpoint_dir / "interrupted.ckpt"
+)
+
+identical = all(
+    np.array_equal(a, b, equal_nan=True)
+    for a, b in zip(jax.tree.leaves(jax.device_get(uninterrupted)),
+                    jax.tree.leaves(jax.device_get(resumed)))
+)
+print(f"Resumed run identical to uninterrupted run: {identical}")
+print(f"Best validation loss: {float(resumed.state.best_val_loss):.6f}")
+
+# %% [markdown]
+# Resuming a run that has already finished just returns its final checkpoint.
+
+# %%
+finished = train_with_checkpoints(
+    train_chunk, initial_state, x_train, y_train, x_val, y_val,
+    train_key, num_blocks, blocks_per_chunk,
+    checkpoint_dir / "interrupted.ckpt"
+)
+print(f"Best validation loss: {float(finished.state.best_val_loss):.6f}")
+
+# %% [markdown]
+# Since writes happen in the background, checkpointing after every chunk costs
+# little compared with checkpointing only at the end of training.
+
+# %%
+for checkpoint_every in (1, -(-num_blocks // blocks_per_chunk)):
+    checkpoint_path = checkpoint_dir / f"every_{checkpoint_every}.ckpt"
+    start = time()
+    train_with_checkpoints(
+        train_chunk, initial_state, x_train, y_train, x_val, y_val,
+        train_key, num_blocks, blocks_per_chunk,
+        checkpoint_path, checkpoint_every=checkpoint_every
+    )
+    print(f"Checkpoint every {checkpoint_every} chunk(s): "
+          f"{time() - start:.2f} seconds")
+print(f"Checkpoint size: {checkpoint_path.stat().st_size / 1e6:.2f} MB")
+
+# %% [markdown]
+# Finally, since the file can be memory-mapped, we can pull out the best
+# parameters for prediction without restoring the rest of the state.
+
+# %%
+checkpoint, metadata = read_checkpoint(
+    checkpoint_dir / "uninterrupted.ckpt",
+    Checkpoint(initial_state, train_key, jnp.zeros(0), jnp.zeros(0))
+)
+y_pred = forward(checkpoint.state.best_θ, x_grid.reshape(-1, 1),
+                 activation=activation)
+print(f"Checkpoint written before block {metadata['next_block']}, "
+      f"validation MSE of best parameters: "
+      f"{float(mse_loss(checkpoint.state.best_θ, x_val, y_val, activation)):.6f}")
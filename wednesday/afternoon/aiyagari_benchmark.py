@@ -0,0 +1,373 @@
+"""
+Scaling benchmarks for the Aiyagari model in aiyagari_jax.ipynb.
+
+For each combination of asset grid size, number of exogenous states and
+discount factor, the suite records the time and peak memory of
+
+* get_greedy (which builds the array B),
+* get_value,
+* compute_asset_stationary,
+* a full household solve (solve_household_compiled), and
+* a full equilibrium computation (compute_equilibrium).
+
+Memory is measured in two ways: the memory that XLA allocates for each
+compiled function (arguments, outputs and temporaries), and the peak resident
+memory of the process.  Each combination of parameters runs in a fresh
+process, so the latter measures that combination alone.  The equilibrium
+computation is not a single compiled function, so only the second measure
+applies to it.
+
+The model code is taken from the notebook itself, so that the benchmarks track
+the code that is actually taught.  Only definitions (imports, functions,
+classes and simple assignments) are executed; demonstrations are skipped.
+
+The exogenous state is discretized with the Rouwenhorst method, normalized so
+that mean labor supply is one.
+
+Results are written to a JSON file.  Passing an earlier results file with
+--compare reports the ratio of each measurement to the earlier one, and exits
+with status 1 if any ratio exceeds --threshold.
+
+Example:
+
+    python aiyagari_benchmark.py --a-sizes 200 400 --z-sizes 2 5 \\
+        --betas 0.96 0.99 --output results.json --compare baseline.json
+
+The suite runs on the CPU with 64 bit floats, and needs no display.
+
+"""
+import argparse
+import ast
+import datetime
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+os.environ.setdefault("JAX_PLATFORMS", "cpu")
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+import jax
+import numpy as np
+
+jax.config.update("jax_enable_x64", True)
+
+
+NOTEBOOK = Path(__file__).with_name("aiyagari_jax.ipynb")
+
+
+def is_definition(node, classes):
+    """
+    Whether a top-level statement of a notebook cell defines something, as
+    opposed to running a computation.  Assignments count as definitions if
+    their value is a constant, a name, an attribute, a lambda, or a call with
+    literal arguments to namedtuple or to a class defined in the notebook.
+
+    """
+    if isinstance(node, (ast.Import, ast.ImportFrom,
+                         ast.FunctionDef, ast.ClassDef)):
+        return True
+    if isinstance(node, ast.Assign):
+        if not all(isinstance(target, ast.Name) for target in node.targets):
+            return False
+        value = node.value
+        if isinstance(value, (ast.Constant, ast.Name,
+                              ast.Attribute, ast.Lambda)):
+            return True
+        return (isinstance(value, ast.Call)
+                and isinstance(value.func, ast.Name)
+                and value.func.id in classes
+                and all(is_literal(arg) for arg in value.args)
+                and all(is_literal(k.value) for k in value.keywords))
+    return False
+
+
+def is_literal(node):
+    """Whether an expression is a Python literal."""
+    try:
+        ast.literal_eval(node)
+    except ValueError:
+        return False
+    return True
+
+
+def load_notebook_definitions(path=NOTEBOOK):
+    """
+    Execute the definitions in the code cells of the notebook at path and
+    return the resulting namespace.  Cells whose imports are unavailable
+    (such as the optional Bayesian optimization cells) are skipped.
+
+    """
+    with open(path) as f:
+        notebook = json.load(f)
+    namespace = {"__name__": "aiyagari_jax"}
+    classes = {"namedtuple"}
+    for index, cell in enumerate(notebook["cells"]):
+        if cell["cell_type"] != "code":
+            continue
+        source = cell["source"]
+        if isinstance(source, list):
+            source = "".join(source)
+        lines = [line for line in source.splitlines()
+                 if not line.lstrip().startswith(("%", "!"))]
+        try:
+            tree = ast.parse("\n".join(lines))
+        except SyntaxError:
+            continue
+        body = []
+        for node in tree.body:
+            if is_definition(node, classes):
+                body.append(node)
+                if isinstance(node, ast.ClassDef):
+                    classes.add(node.name)
+        filename = f"{Path(path).name}, cell {index}"
+        try:
+            exec(compile(ast.Module(body, type_ignores=[]), filename, "exec"),
+                 namespace)
+        except ImportError:
+            continue
+    return namespace
+
+
+def rouwenhorst(n, ρ, σ):
+    """
+    Discretize the AR(1) process x' = ρ x + σ ε by the Rouwenhorst method,
+    returning the grid and the transition matrix.
+
+    """
+    p = (1 + ρ) / 2
+    Π = np.array([[p, 1 - p], [1 - p, p]])
+    for m in range(3, n + 1):
+        Π_new = np.zeros((m, m))
+        Π_new[:-1, :-1] += p * Π
+        Π_new[:-1, 1:] += (1 - p) * Π
+        Π_new[1:, :-1] += (1 - p) * Π
+        Π_new[1:, 1:] += p * Π
+        Π_new[1:-1, :] /= 2
+        Π = Π_new
+    ψ = math.sqrt(n - 1) * σ / math.sqrt(1 - ρ**2)
+    return np.linspace(-ψ, ψ, n), Π
+
+
+def create_benchmark_household(model, a_size, z_size, β, ρ=0.9, σ=0.1):
+    """
+    Create a household whose log labor productivity follows a discretized
+    AR(1) process, normalized so that mean productivity is one.
+
+    """
+    x_grid, Π = rouwenhorst(z_size, ρ, σ)
+    # The stationary distribution of the Rouwenhorst chain is binomial
+    ψ = np.array([math.comb(z_size - 1, j) for j in range(z_size)])
+    ψ = ψ / ψ.sum()
+    z_grid = np.exp(x_grid) / np.sum(ψ * np.exp(x_grid))
+    return model["create_household"](β=β, Π=Π.tolist(),
+                                     z_grid=z_grid.tolist(), a_size=a_size)
+
+
+def peak_resident_bytes():
+    """
+    Peak resident memory of this process in bytes, or None where it is not
+    available.
+
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else 1024 * peak
+
+
+def compiled_bytes(jitted, *args):
+    """
+    Memory that XLA allocates for a call to a jitted function: arguments,
+    outputs and temporaries.
+
+    """
+    analysis = jitted.lower(*args).compile().memory_analysis()
+    if analysis is None:
+        return None
+    return (analysis.argument_size_in_bytes + analysis.output_size_in_bytes
+            + analysis.temp_size_in_bytes - analysis.alias_size_in_bytes)
+
+
+def measure(f, *args, repeat=10, setup=None):
+    """
+    Call f(*args) once to compile, then repeat times, returning the fastest
+    time.  If setup is given, it is called before every call of f.
+
+    """
+    times = []
+    for _ in range(repeat + 1):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        jax.block_until_ready(f(*args))
+        times.append(time.perf_counter() - start)
+    return min(times[1:])
+
+
+def benchmark_point(model, a_size, z_size, β, repeat=10):
+    """
+    Run every benchmark at one combination of parameters, returning a list
+    of result dictionaries.
+
+    """
+    household = create_benchmark_household(model, a_size, z_size, β)
+    prices = model["create_prices"]()
+    firm = model["create_firm"]()
+    solution = model["solve_household_compiled"](household, prices)
+    σ, v = solution.σ, solution.v_σ
+
+    benchmarks = {
+        "get_greedy": (model["get_greedy"], (v, household, prices)),
+        "get_value": (model["get_value"], (σ, household, prices)),
+        "compute_asset_stationary": (model["compute_asset_stationary"],
+                                     (σ, household)),
+        "solve_household": (model["solve_household_compiled"],
+                            (household, prices)),
+    }
+    results = []
+    for name, (jitted, args) in benchmarks.items():
+        results.append(dict(name=name,
+                            seconds=measure(jitted, *args, repeat=repeat),
+                            compiled_bytes=compiled_bytes(jitted, *args)))
+
+    # The equilibrium runs Python loops over many compiled functions, so XLA
+    # cannot report its memory use.  The solution cache is cleared before each
+    # run so that every run does the same work.
+    seconds = measure(model["compute_equilibrium"], firm, household,
+                      repeat=1, setup=model["solution_cache"].clear)
+    results.append(dict(name="compute_equilibrium", seconds=seconds,
+                        compiled_bytes=None))
+
+    peak_bytes = peak_resident_bytes()
+    for result in results:
+        result.update(a_size=a_size, z_size=z_size, β=β,
+                      peak_resident_bytes=peak_bytes)
+    return results
+
+
+def run_point(a_size, z_size, β, repeat, notebook):
+    """
+    Run benchmark_point in a fresh Python process, so that compilation
+    caches and memory use do not carry over between points, and the peak
+    resident memory of the process measures that point alone.
+
+    """
+    command = [sys.executable, __file__, "--point", str(a_size), str(z_size),
+               str(β), "--repeat", str(repeat), "--notebook", notebook]
+    output = subprocess.run(command, check=True, capture_output=True,
+                            text=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def metadata():
+    device = jax.devices()[0]
+    return dict(
+        date=datetime.datetime.now().isoformat(timespec="seconds"),
+        python=platform.python_version(),
+        jax=jax.__version__,
+        platform=device.platform,
+        device=device.device_kind,
+        cpu_count=os.cpu_count(),
+        machine=platform.machine(),
+    )
+
+
+def result_key(result):
+    return (result["a_size"], result["z_size"], result["β"], result["name"])
+
+
+def compare(results, baseline, threshold):
+    """
+    Print the ratio of each time and memory measurement in results to its
+    value in baseline, returning True if any ratio exceeds threshold.
+
+    """
+    fields = ("seconds", "compiled_bytes", "peak_resident_bytes")
+    previous = {result_key(result): result for result in baseline}
+    regressed = False
+    print(f"\n{'a_size':>6} {'z_size':>6} {'β':>6} {'benchmark':>25} "
+          f"{'time':>7} {'XLA':>7} {'peak':>7}")
+    for result in results:
+        old = previous.get(result_key(result))
+        if old is None:
+            continue
+        ratios = [result[field] / old[field]
+                  if result[field] is not None and old.get(field) else None
+                  for field in fields]
+        flag = any(r is not None and r > threshold for r in ratios)
+        regressed = regressed or flag
+        ratios = [f"{r:.2f}" if r is not None else "-" for r in ratios]
+        print(f"{result['a_size']:>6} {result['z_size']:>6} "
+              f"{result['β']:>6} {result['name']:>25} "
+              + " ".join(f"{r:>7}" for r in ratios)
+              + ("  <--" if flag else ""))
+    return regressed
+
+
+def format_bytes(n):
+    return "-" if n is None else f"{n / 1e6:.1f}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--a-sizes", type=int, nargs="+",
+                        default=[200, 400, 800])
+    parser.add_argument("--z-sizes", type=int, nargs="+", default=[2, 5])
+    parser.add_argument("--betas", type=float, nargs="+",
+                        default=[0.96, 0.99])
+    parser.add_argument("--repeat", type=int, default=10,
+                        help="timed calls per compiled function")
+    parser.add_argument("--output", default="aiyagari_benchmark.json")
+    parser.add_argument("--compare", metavar="BASELINE",
+                        help="earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="largest acceptable ratio to the baseline")
+    parser.add_argument("--notebook", default=str(NOTEBOOK))
+    parser.add_argument("--point", nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.point is not None:
+        a_size, z_size, β = args.point
+        model = load_notebook_definitions(args.notebook)
+        results = benchmark_point(model, int(a_size), int(z_size), float(β),
+                                  repeat=args.repeat)
+        print(json.dumps(results, ensure_ascii=False))
+        return
+
+    results = []
+    print(f"{'a_size':>6} {'z_size':>6} {'β':>6} {'benchmark':>25} "
+          f"{'seconds':>9} {'XLA MB':>8} {'peak MB':>8}")
+    for a_size in args.a_sizes:
+        for z_size in args.z_sizes:
+            for β in args.betas:
+                for result in run_point(a_size, z_size, β, args.repeat,
+                                        args.notebook):
+                    print(f"{a_size:>6} {z_size:>6} {β:>6} "
+                          f"{result['name']:>25} {result['seconds']:>9.4f} "
+                          f"{format_bytes(result['compiled_bytes']):>8} "
+                          f"{format_bytes(result['peak_resident_bytes']):>8}",
+                          flush=True)
+                    results.append(result)
+
+    with open(args.output, "w") as f:
+        json.dump(dict(metadata=metadata(), results=results), f, indent=2,
+                  ensure_ascii=False)
+    print(f"\nResults written to {args.output}")
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()